@@ -11,9 +11,13 @@
     and the camera's h264 stream. Only one stream is allowed to be served at a time.
     The h264 stream should not be used with a lambda using KVS.
 """
-from threading import Thread, Event
+from threading import Thread, Event, Condition, Lock, local
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields, MISSING
 import os
 import stat
+import sys
+import subprocess
 import ssl
 import json
 import logging
@@ -22,6 +26,12 @@ import queue
 from flask import Flask, Response, render_template
 import numpy as np
 import cv2
+try:
+    from turbojpeg import TurboJPEG
+    TURBO_JPEG = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG or libturbojpeg is not installed, frames are encoded with OpenCV.
+    TURBO_JPEG = None
 
 # List of valid resolutions
 RESOLUTION = {'1080p' : (1920, 1080), '720p' : (1280, 720), '480p' : (858, 480)}
@@ -31,6 +41,24 @@ MXUVC_BIN = "/opt/awscam/camera/installed/bin/mxuvc"
 CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.json')
 # Path to certificate generation bash script.
 CERT_GEN = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'gen_certs.sh')
+# JPEG start and end of image markers, used to split the MJPEG byte stream into frames.
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+# Amount of time in seconds to wait between checks for the video source FIFO.
+FIFO_POLL_INTERVAL = 0.05
+# Number of bytes to read from the MJPEG FIFO per system call.
+MJPEG_READ_SIZE = 64 * 1024
+# GStreamer pipeline used to decode the h264 stream, the decoder element is taken from
+# the configuration so that the hardware decoder of the device is used. The frames are
+# delivered as I420 when TurboJPEG can encode them directly, and as BGR otherwise.
+H264_PIPELINE = ('filesrc location={} ! h264parse ! {} ! videoconvert ! '
+                 'video/x-raw,format={} ! appsink sync=false max-buffers=1 drop=true')
+# Multipart headers written before and after each JPEG in the stream response.
+FRAME_PREFIX = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+FRAME_SUFFIX = b'\r\n'
+# White 480p JPEG served to the client when no frame is available.
+BLANK_JPEG = cv2.imencode('.jpg', np.full((RESOLUTION['480p'][1], RESOLUTION['480p'][0], 3),
+                                          255, np.uint8))[1].tobytes()
 
 def set_camera_prop(fps, resolution):
     """ Helper method that sets the cameras frame rate and resolution. Used
@@ -40,8 +68,61 @@ def set_camera_prop(fps, resolution):
         resolution - Tuple of (width, height) for desired resolution, accepted
                      values in RESOLUTION.
     """
-    os.system("{} --ch 1 framerate {}".format(MXUVC_BIN, fps))
-    os.system("{} --ch 1 resolution {} {}".format(MXUVC_BIN, resolution[0], resolution[1]))
+    try:
+        subprocess.run([MXUVC_BIN, '--ch', '1', 'framerate', str(fps)], check=False)
+        subprocess.run([MXUVC_BIN, '--ch', '1', 'resolution', str(resolution[0]),
+                        str(resolution[1])], check=False)
+    except OSError as err:
+        logging.getLogger('AWSVideoServer').error('Failed to run %s: %s', MXUVC_BIN, err)
+
+# Scratch buffer of each encoder thread that TurboJPEG encodes into.
+encoder_scratch = local()
+
+def encode_jpeg(frame, quality, restart_interval, yuv=False):
+    """ Helper method that encodes a frame to JPEG, returns the encoded bytes.
+        Uses TurboJPEG when it is installed and OpenCV otherwise, both release the
+        GIL while encoding, so this can be run on several threads in parallel.
+        frame - BGR image to encode, or I420 image if yuv is True.
+        quality - JPEG quality from 0 to 100.
+        restart_interval - Number of MCU's between restart markers, 0 to disable. Only
+                           supported by the OpenCV encoder.
+        yuv - True if the frame is a planar I420 image, only supported by TurboJPEG.
+              PyTurboJPEG can not encode YUV planes into a caller provided buffer, so
+              this path allocates an output buffer per frame instead of using the
+              thread's scratch buffer.
+    """
+    if yuv:
+        # The YUV planes are compressed as is, skipping the conversion to and from BGR.
+        # OpenCV stores the planes without row padding.
+        return TURBO_JPEG.encode_from_yuv(frame, frame.shape[0] * 2 // 3, frame.shape[1],
+                                          quality=quality, align=1)
+    if TURBO_JPEG is None:
+        # Optimized Huffman tables roughly double the cost of an encode.
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+                  cv2.IMWRITE_JPEG_RST_INTERVAL, restart_interval]
+        return cv2.imencode('.jpg', frame, params)[1].tobytes()
+    # Encode into a buffer that is reused by the calling thread, so that no output
+    # buffer is allocated by libjpeg-turbo for each frame.
+    size = TURBO_JPEG.buffer_size(frame)
+    scratch = getattr(encoder_scratch, 'buffer', None)
+    if scratch is None or len(scratch) < size:
+        scratch = encoder_scratch.buffer = bytearray(size)
+    _, jpeg_size = TURBO_JPEG.encode(frame, quality=quality, dst=scratch)
+    return bytes(memoryview(scratch)[:jpeg_size])
+
+def frame_hash(frame, yuv=False):
+    """ Helper method that returns a perceptual hash of a frame, the mean of each
+        cell of an 8x8 grid. Costs microseconds compared to milliseconds for an encode,
+        but motion of small objects rarely changes the hash, so it is only suited to
+        mostly static scenes.
+        frame - BGR image to hash, or I420 image if yuv is True.
+        yuv - True if the frame is a planar I420 image, only its Y plane is hashed.
+    """
+    if yuv:
+        return cv2.resize(frame[:frame.shape[0] * 2 // 3], (8, 8),
+                          interpolation=cv2.INTER_AREA).tobytes()
+    return cv2.resize(frame, (8, 8), interpolation=cv2.INTER_AREA) \
+              .mean(axis=2).astype(np.uint8).tobytes()
 
 def invalid_key(missing_key):
     """ Helper method, returns error message for a missing key in the config.json file.
@@ -50,97 +131,300 @@ def invalid_key(missing_key):
     """
     return 'Configuration file missig key: {}'.format(missing_key)
 
+@dataclass(frozen=True)
+class VideoConfig(object):
+    """ Configuration of the video server, loaded once from config.json so that missing
+        keys are reported at startup. The tuning keys have defaults so that existing
+        config.json files keep working.
+    """
+    video_release_timeout: float
+    live_stream_src: str
+    max_buffer_size: int
+    proj_stream_src: str
+    live_resolution: str
+    stream_timeout: float
+    ca_path: str
+    server_cert_path: str
+    server_key_path: str
+    live_fps: int
+    port: int
+    original_live_framerate: int
+    original_live_resolution: str
+    encoder_threads: int = 2
+    reuse_unchanged_frames: bool = False
+    jpeg_quality: int = 75
+    jpeg_restart_interval: int = 8
+    h264_decoder: str = 'vaapih264dec'
+
+    def __post_init__(self):
+        """ Raises ValueError if a resolution is not one of RESOLUTION."""
+        for resolution in (self.live_resolution, self.original_live_resolution):
+            if resolution not in RESOLUTION:
+                raise ValueError('Invalid resolution {}'.format(resolution))
+
+    @classmethod
+    def from_dict(cls, config_dict):
+        """ Creates the configuration from the contents of config.json, raises KeyError
+            if a required key is missing and ValueError if a value is invalid.
+            config_dict - Dictionary loaded from config.json.
+        """
+        return cls(**{field.name: config_dict[field.name] for field in fields(cls)
+                      if field.default is MISSING or field.name in config_dict})
+
+class FrameBuffer(object):
+    """ Ring of JPEG's shared between a video worker and its clients. There is a single
+        producer (the video worker) and any number of readers, each reader keeps its own
+        position in the ring so that every client is served from the same encoded frames.
+        Frames are written and read without taking a lock, the lock is only taken when
+        a reader has to wait for a new frame and by the producer to wake it. When the
+        ring is full the oldest frame is overwritten, so a slow client skips ahead to
+        the most recent frames of a live stream.
+    """
+    def __init__(self, max_size):
+        """ max_size - Maximum number of frames that can be stored in the buffer."""
+        self.slots = [None] * max_size
+        # Number of frames written, only written by the producer.
+        self.tail = 0
+        # Number of readers waiting for a frame, only written with frame_ready held.
+        self.waiting = 0
+        self.frame_ready = Condition()
+
+    def put(self, jpeg):
+        """ Adds a frame to the buffer, overwriting the oldest frame if it is full.
+            jpeg - Encoded frame to add.
+        """
+        self.slots[self.tail % len(self.slots)] = jpeg
+        self.tail += 1
+        # A reader registers as waiting before checking tail, so it either sees the
+        # new frame or is counted here.
+        if self.waiting:
+            with self.frame_ready:
+                self.frame_ready.notify_all()
+
+    def get(self, position, timeout):
+        """ Returns the oldest frame at or after position that has not been overwritten,
+            along with the position of the next frame. Returns None and the unchanged
+            position if no frame became available within timeout seconds.
+            position - Number of frames written to the buffer when the reader last read.
+            timeout - Amount of time in seconds to wait for a frame.
+        """
+        if self.tail <= position:
+            with self.frame_ready:
+                self.waiting += 1
+                try:
+                    if not self.frame_ready.wait_for(lambda: self.tail > position, timeout):
+                        return None, position
+                finally:
+                    self.waiting -= 1
+        # Skip the frames that have been overwritten by the producer.
+        position = max(position, self.tail - len(self.slots))
+        return self.slots[position % len(self.slots)], position + 1
+
 class VideoWorker(Thread):
     """ Standard video worker class, that uses openCV to attain images
-        from the camera and place them in a queue to be retrieved by the
+        from the camera and place them in a buffer to be retrieved by the
         client.
     """
-    def __init__(self, video_src, config_dict, logger):
+    def __init__(self, video_src, config, logger):
         """ video_src - Location of the video source to grab the capture from
-            config_dict - Dictionary containing the amount of time in seconds to wait to
-                          retrieve images from the queue (stream_timeout). The maximum
-                          number of frames that can be stored in the queue (max_buffer_size).
-                          Amount of time in seconds to wait to retrieve images
-                          from the queue (stream_timeout).
+            config - VideoConfig containing the amount of time in seconds to wait to
+                     retrieve images from the buffer (stream_timeout). The maximum
+                     number of frames that can be stored in the buffer (max_buffer_size).
+                     Amount of time in seconds to wait to release the video
+                     capture when stopping (video_release_timeout). The number of
+                     threads used to encode frames (encoder_threads). Whether to skip
+                     encoding frames that are unchanged from the previous one
+                     (reuse_unchanged_frames). The quality of the encoded JPEG's
+                     (jpeg_quality) and the number of MCU's between their restart
+                     markers (jpeg_restart_interval).
             logger - Logger object use to log to the system.
         """
         super().__init__()
         self.video_src = video_src
-        try:
-            self.video_release_timeout = config_dict["video_release_timeout"]
-            self.stream_timeout = config_dict['stream_timeout']
-            self.img_queue = queue.Queue(maxsize=config_dict["max_buffer_size"])
-        except KeyError as missing_key:
-            logger.error(invalid_key(missing_key))
-
+        self.logger = logger
+        self.video_release_timeout = config.video_release_timeout
+        self.stream_timeout = config.stream_timeout
+        self.img_buffer = FrameBuffer(config.max_buffer_size)
+        self.encoder_threads = config.encoder_threads
+        self.reuse_unchanged_frames = config.reuse_unchanged_frames
+        self.jpeg_quality = config.jpeg_quality
+        self.jpeg_restart_interval = config.jpeg_restart_interval
+        # True if open_capture returns I420 frames instead of BGR frames.
+        self.yuv_frames = False
         self.stop_request = Event()
 
-    def run(self):
-        # Wait until a lambda constructs the results FIFO. The server can not
-        # create this FIFO file because lambda and the server are run as two
-        #separate  users. The server should be read only.
-        while not stat.S_ISFIFO(os.stat(self.video_src).st_mode):
-            continue
-        video_capture = cv2.VideoCapture(self.video_src)
-        while not self.stop_request.isSet():
-            ret, frame = video_capture.read()
+    def wait_for_fifo(self):
+        """ Waits until a lambda constructs the video source FIFO. The server can not
+            create this FIFO file because lambda and the server are run as two
+            separate users. The server should be read only. Returns False if the
+            worker was stopped before the FIFO was created.
+        """
+        while not self.stop_request.is_set():
             try:
+                if stat.S_ISFIFO(os.stat(self.video_src).st_mode):
+                    return True
+            except OSError:
+                pass
+            self.stop_request.wait(FIFO_POLL_INTERVAL)
+        return False
+
+    def open_capture(self):
+        """ Returns the video capture used to read frames from the video source."""
+        return cv2.VideoCapture(self.video_src)
+
+    def run(self):
+        if not self.wait_for_fifo():
+            return
+        video_capture = self.open_capture()
+        # The frames go through a pipeline of stages that each run on their own
+        # threads: this thread reads and decodes, a pool of threads encodes, the
+        # publisher thread puts the encoded frames in the buffer in capture order and
+        # the client threads stream them out.
+        pending = queue.Queue(maxsize=self.encoder_threads)
+        publisher = Thread(target=self.publish_frames, args=(pending,))
+        publisher.start()
+        last_hash = None
+        last_jpeg = None
+        with ThreadPoolExecutor(max_workers=self.encoder_threads) as encoder:
+            while not self.stop_request.is_set():
+                # grab() only reads the next frame, retrieve() decodes and copies it. While
+                # every encoder thread is busy frames are dropped before they are decoded.
+                if not video_capture.grab() or pending.full():
+                    continue
+                ret, frame = video_capture.retrieve()
                 if ret:
-                    jpeg = cv2.imencode('.jpg', frame)[1]
-                    self.img_queue.put_nowait(jpeg)
-            except queue.Full:
-                continue
+                    # Publish the previous JPEG again if the scene has not changed.
+                    current_hash = None
+                    if self.reuse_unchanged_frames:
+                        current_hash = frame_hash(frame, self.yuv_frames)
+                    if current_hash is None or current_hash != last_hash:
+                        last_jpeg = encoder.submit(encode_jpeg, frame, self.jpeg_quality,
+                                                   self.jpeg_restart_interval, self.yuv_frames)
+                    last_hash = current_hash
+                    pending.put(last_jpeg)
         video_capture.release()
+        # Every encode has finished once the executor is shut down, and the publisher
+        # skips failed frames, so it drains the queue and receives the sentinel.
+        pending.put(None)
+        publisher.join()
 
-    def get_img_bytes(self):
-        """ Returns the jpeg bytes from the last frame retrieved from the queue"""
-        try:
-            return self.img_queue.get(timeout=self.stream_timeout).tobytes()
-        except queue.Empty:
-            white_canvas = 255 * np.ones([RESOLUTION['480p'][0],
-                                          RESOLUTION['480p'][1], 3])
-            jpeg = cv2.imencode('.jpg', cv2.resize(white_canvas,
-                                                   RESOLUTION['480p']))[1]
-            return jpeg.tobytes()
+    def publish_frames(self, pending):
+        """ Puts the encoded frames in the buffer as soon as they are ready, in the
+            order they were captured. Runs until it receives None. A frame that failed
+            to encode is logged and skipped, so that the queue keeps draining.
+            pending - Queue of the futures of the frames being encoded.
+        """
+        while True:
+            jpeg = pending.get()
+            if jpeg is None:
+                return
+            try:
+                self.img_buffer.put(jpeg.result())
+            except Exception as err:
+                self.logger.error('Failed to encode frame: %s', err)
+
+    def get_img_bytes(self, position):
+        """ Returns the jpeg bytes of the next frame in the buffer and the position of
+            the frame after it. Frames are stored as bytes, so they are handed to the
+            response without a copy.
+            position - Buffer position returned by the previous call, 0 for a new client.
+        """
+        jpeg, position = self.img_buffer.get(position, self.stream_timeout)
+        if jpeg is None:
+            return BLANK_JPEG, position
+        return jpeg, position
 
     def join(self, timeout=None):
         self.stop_request.set()
         super().join(self.video_release_timeout)
 
+class MJPEGVideoWorker(VideoWorker):
+    """ Video worker for the project stream. The lambda already writes JPEG's
+        to the FIFO, so the frames are split out of the byte stream and placed
+        in the buffer as is, instead of being decoded and re-encoded.
+    """
+    def run(self):
+        if not self.wait_for_fifo():
+            return
+        fifo = os.open(self.video_src, os.O_RDONLY)
+        stream = bytearray()
+        try:
+            while not self.stop_request.is_set():
+                data = os.read(fifo, MJPEG_READ_SIZE)
+                if not data:
+                    # The lambda closed its end of the FIFO.
+                    break
+                stream += data
+                for jpeg in self.split_frames(stream):
+                    self.img_buffer.put(jpeg)
+        finally:
+            os.close(fifo)
+
+    @staticmethod
+    def split_frames(stream):
+        """ Removes every complete JPEG from the front of the stream and returns them
+            as a list of bytes, any partial frame is left in the stream.
+            stream - bytearray holding the data read from the FIFO.
+        """
+        frames = []
+        while True:
+            start = stream.find(JPEG_SOI)
+            if start < 0:
+                # Keep a trailing 0xff in case it is the first half of a marker.
+                del stream[:-1]
+                return frames
+            end = stream.find(JPEG_EOI, start + len(JPEG_SOI))
+            if end < 0:
+                del stream[:start]
+                return frames
+            end += len(JPEG_EOI)
+            frames.append(bytes(stream[start:end]))
+            del stream[:end]
+
 class H264VideoWorker(VideoWorker):
     """Video worker for the H264 stream, sets the cameras h264 channels
        resolution and framerate so that the decoder can keep up with the
        server.
     """
-    def __init__(self, video_src, config_dict, logger):
+    def __init__(self, video_src, config, logger):
         """ video_src - Location of the video source to grab the capture from
-            config_dict - Dictionary containing the target resolution for the served frames
-                          (resolution). The target framerate (live_fps). The original resolution
-                          fo the camera (original_live_resolution). The Original framerate of
-                          the camera (original_live_framerate).
+            config - VideoConfig containing the target resolution for the served frames
+                     (live_resolution). The target framerate (live_fps). The original resolution
+                     fo the camera (original_live_resolution). The Original framerate of
+                     the camera (original_live_framerate). The GStreamer element used to
+                     decode the h264 stream (h264_decoder).
             logger - Logger object use to log to the system.
         """
-        super().__init__(video_src, config_dict, logger)
-        try:
-            self.resolution = config_dict['live_resolution']
-            self.orginal_resolution = config_dict['original_live_resolution']
-            self.frame_rate = config_dict['live_fps']
-            self.original_framerate = config_dict['original_live_framerate']
-        except KeyError as missing_key:
-            logger.error(invalid_key(missing_key))
+        super().__init__(video_src, config, logger)
+        self.resolution = RESOLUTION[config.live_resolution]
+        self.orginal_resolution = RESOLUTION[config.original_live_resolution]
+        self.frame_rate = config.live_fps
+        self.original_framerate = config.original_live_framerate
+        self.decoder = config.h264_decoder
 
-        check_res = lambda resolution: 1 if resolution in RESOLUTION \
-                                         else logger.error('Invalid resolution {}' \
-                                                            .format(resolution))
-        check_res(self.resolution)
-        check_res(self.orginal_resolution)
+    def open_capture(self):
+        """ Returns a GStreamer capture that decodes the h264 stream with the configured
+            decoder, falls back to the default capture if the pipeline can not be opened.
+            The capture returns I420 frames if TurboJPEG is available to encode them.
+        """
+        self.yuv_frames = TURBO_JPEG is not None
+        frame_format = 'I420' if self.yuv_frames else 'BGR'
+        video_capture = cv2.VideoCapture(H264_PIPELINE.format(self.video_src, self.decoder,
+                                                              frame_format),
+                                         cv2.CAP_GSTREAMER)
+        if video_capture.isOpened():
+            return video_capture
+        self.yuv_frames = False
+        self.logger.warning('Failed to open %s pipeline, using software decoding',
+                            self.decoder)
+        return super().open_capture()
 
     def run(self):
-        set_camera_prop(self.frame_rate, RESOLUTION[self.resolution])
+        set_camera_prop(self.frame_rate, self.resolution)
         super().run()
 
     def join(self, timeout=None):
-        set_camera_prop(self.original_framerate, RESOLUTION[self.orginal_resolution])
+        set_camera_prop(self.original_framerate, self.orginal_resolution)
         super().join()
 
 class VideoApp(object):
@@ -153,15 +437,27 @@ class VideoApp(object):
         handler = logging.handlers.SysLogHandler(address='/dev/log')
         handler.setFormatter(logging.Formatter('%(name)s: <%(levelname)s> %(message)s'))
         self.logger.addHandler(handler)
-        # Lambda for verifying the existence of a file.
-        check_file = lambda file: 1 if os.path.isfile(file) \
-                                    else self.logger.error('%s not found', file)
         # Load configuration
-        check_file(CONFIG_PATH)
+        if not os.path.isfile(CONFIG_PATH):
+            self.logger.error('%s not found', CONFIG_PATH)
         with open(CONFIG_PATH) as config_file:
-            self.config_dict = json.load(config_file)
+            config_dict = json.load(config_file)
+        try:
+            self.config = VideoConfig.from_dict(config_dict)
+        except KeyError as missing_key:
+            self.logger.error(invalid_key(missing_key))
+            raise
+        except ValueError as err:
+            self.logger.error('Invalid configuration: %s', err)
+            raise
+        if TURBO_JPEG is not None and self.config.jpeg_restart_interval:
+            self.logger.warning('jpeg_restart_interval has no effect, frames are encoded '
+                                'with TurboJPEG which does not support restart markers')
 
         self.video_worker = None
+        # Number of clients streaming from the video worker, guarded by worker_lock.
+        self.subscribers = 0
+        self.worker_lock = Lock()
         self.app = Flask(__name__)
         # Add the API endpoints
         self.app.add_url_rule('/', 'index', self.index, methods=['GET'])
@@ -172,80 +468,118 @@ class VideoApp(object):
                               self.video_feed_live, methods=['GET'])
        # Client authentication via self-signed certificates
         self.app.secret_key = os.urandom(12)
-        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        # The default context allows TLS 1.3 and its shorter handshake, and keeps
+        # OpenSSL's server session cache and session tickets enabled so that
+        # reconnecting clients can resume their session.
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
         context.verify_mode = ssl.CERT_REQUIRED
-        try:
-            check_file(CERT_GEN)
-            if not os.path.isfile(self.config_dict["ca_path"]):
-                os.system('bash {}'.format(CERT_GEN))
-
-            context.load_verify_locations(self.config_dict["ca_path"])
-            context.load_cert_chain(self.config_dict["server_cert_path"],
-                                    self.config_dict["server_key_path"])
-            self.app.run(host='0.0.0.0', port=self.config_dict["port"],
-                         ssl_context=context, threaded=True, debug=False)
-        except KeyError as missing_key:
-            self.logger.error(invalid_key(missing_key))
+        if not os.path.isfile(CERT_GEN):
+            self.logger.error('%s not found', CERT_GEN)
+        if not os.path.isfile(self.config.ca_path):
+            os.system('bash {}'.format(CERT_GEN))
+
+        context.load_verify_locations(self.config.ca_path)
+        context.load_cert_chain(self.config.server_cert_path, self.config.server_key_path)
+        self.app.run(host='0.0.0.0', port=self.config.port,
+                     ssl_context=context, threaded=True, debug=False)
 
     def index(self):
         """ Entry point for the client."""
         return render_template('index.html')
 
     def exit(self):
-        """ Stops the current video worker. Intended to be called when the client
-            navigated away or closes from the current tab."""
-        self.stop_video_worker()
+        """ Stops the current video worker if no other client is streaming from it.
+            Intended to be called when the client navigated away or closes from the
+            current tab, the worker is also stopped once its last client disconnects."""
+        with self.worker_lock:
+            if not self.subscribers:
+                self.stop_video_worker()
         return ('', 200)
 
     def video_feed_proj(self):
-        """ Stops the current video worker, creates a new video worker, and begins
-            generating JPEG's."""
+        """ Subscribes the client to the project stream, starting its video worker if
+            it is not already running, and begins generating JPEG's."""
         self.logger.info("Starting project feed")
-        try:
-            self.start_video_worker(self.config_dict["proj_stream_src"], True)
-        except KeyError as missing_key:
-            self.logger.error(invalid_key(missing_key))
-        return Response(self.gen_stream(),
-                        mimetype='multipart/x-mixed-replace; boundary=frame')
+        return self.subscribe(self.config.proj_stream_src, True)
 
     def video_feed_live(self):
-        """ Stops the current video worker, creates a new video worker, and begins
-            generating JPEG's.
+        """ Subscribes the client to the live stream, starting its video worker if
+            it is not already running, and begins generating JPEG's.
         """
         self.logger.info("Starting live feed")
-        try:
-            self.start_video_worker(self.config_dict["live_stream_src"], False)
-        except KeyError as missing_key:
-            self.logger.error(invalid_key(missing_key))
-        return Response(self.gen_stream(),
-                        mimetype='multipart/x-mixed-replace; boundary=frame')
+        return self.subscribe(self.config.live_stream_src, False)
+
+    def subscribe(self, video_src, is_project_stream):
+        """ Helper method that starts the video worker for the video source if needed
+            and returns the streaming response for a new client.
+            video_src - Location of the video source
+            is_project_stream - True if subscribing to the project stream, False if
+                                subscribing to the live stream.
+        """
+        with self.worker_lock:
+            self.start_video_worker(video_src, is_project_stream)
+            self.subscribers += 1
+        response = Response(self.gen_stream(),
+                            mimetype='multipart/x-mixed-replace; boundary=frame')
+        response.call_on_close(self.unsubscribe)
+        return response
+
+    def unsubscribe(self):
+        """ Called when a client disconnects, stops the video worker once no client
+            is streaming from it."""
+        with self.worker_lock:
+            self.subscribers -= 1
+            if not self.subscribers:
+                self.stop_video_worker()
 
     def gen_stream(self):
         """ Generates JPEG's of the desired stream."""
+        video_worker = None
+        position = 0
         while True:
-            yield (b'--frame\r\n'b'Content-Type: image/jpeg\r\n\r\n'
-                   + self.video_worker.get_img_bytes() + b'\r\n')
+            # Only one stream is served at a time, follow the current video worker
+            # if another client switched streams.
+            if self.video_worker is not video_worker:
+                video_worker = self.video_worker
+                position = 0
+            jpeg, position = video_worker.get_img_bytes(position)
+            # Werkzeug writes every yielded chunk to the socket unbuffered, so the frame
+            # is yielded whole, joining the parts with a single copy.
+            yield b''.join((FRAME_PREFIX, jpeg, FRAME_SUFFIX))
 
     def stop_video_worker(self):
-        """ Helper method that stops the video worker"""
-        if self.video_worker and self.video_worker.isAlive():
+        """ Helper method that stops the video worker, must be called with worker_lock
+            held when serving requests."""
+        if self.video_worker and self.video_worker.is_alive():
             self.video_worker.join()
 
     def start_video_worker(self, video_src, is_project_stream):
-        """ Helper method that starts the video worker based on video source.
+        """ Helper method that starts the video worker based on video source, the
+            running video worker is reused if it already serves the video source.
+            Must be called with worker_lock held.
             video_src - Location of the video source
             is_project_stream - True if starting the project stream, False if
                                 starting the live stream.
         """
+        # A worker that was asked to stop may still be alive while it releases the
+        # capture, it must not be reused since it is about to exit.
+        if (self.video_worker and self.video_worker.is_alive()
+                and not self.video_worker.stop_request.is_set()
+                and self.video_worker.video_src == video_src):
+            return
         self.stop_video_worker()
         if is_project_stream:
-            self.video_worker = VideoWorker(video_src, self.config_dict, self.logger)
+            self.video_worker = MJPEGVideoWorker(video_src, self.config, self.logger)
         else:
             if not stat.S_ISFIFO(os.stat(video_src).st_mode):
                 self.logger.error('Missing h264 pipe')
-            self.video_worker = H264VideoWorker(video_src, self.config_dict, self.logger)
+            self.video_worker = H264VideoWorker(video_src, self.config, self.logger)
 
         self.video_worker.start()
 
 if __name__ == '__main__':
+    # Switch threads more often than the 5 ms default, so that the capture, publisher
+    # and client threads hand frames to each other with less delay.
+    sys.setswitchinterval(0.001)
     VideoApp()